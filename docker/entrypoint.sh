@@ -210,7 +210,11 @@ unfsd -e /etc/exports -i /var/run/unfsd.pid -d > /var/log/netboot/unfsd.log 2>&1
 # Start Web UI (Flask API)
 echo "  Starting Web UI on port 38434..."
 cd /webui
-python3 app.py > /var/log/netboot/webui.log 2>&1 &
+if command -v gunicorn >/dev/null 2>&1; then
+    gunicorn -c gunicorn.conf.py app:app > /var/log/netboot/webui.log 2>&1 &
+else
+    python3 app.py > /var/log/netboot/webui.log 2>&1 &
+fi
 cd /
 
 
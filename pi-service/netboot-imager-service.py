@@ -3,16 +3,42 @@
 Netboot Image Writer Service
 Runs on Raspberry Pi to receive write-to-disk requests from netboot server
 Uses only Python standard library - no external dependencies
+(isal or pigz are used for faster gzip decoding and orjson for JSON when present)
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import subprocess
 import os
 import json
+import fcntl
+import hmac
+import ipaddress
+import mmap
+import queue
+import shutil
+import socket
+import urllib.request
+import zlib
 from pathlib import Path
 import threading
 import time
 
+try:
+    # ISA-L gzip decoding is 2-3x faster than zlib on ARM
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    # orjson parses bytes and serializes straight to bytes
+    import orjson
+    dump_json = orjson.dumps
+    load_json = orjson.loads
+except ImportError:
+    def dump_json(data):
+        return json.dumps(data).encode()
+    load_json = json.loads
+
 # Load configuration
 CONFIG_FILE = Path(__file__).parent / 'config.json'
 
@@ -29,67 +55,410 @@ def load_config():
 
 config = load_config()
 
-# Global progress tracking
+# Image streaming parameters
+READ_CHUNK_SIZE = 1024 * 1024  # HTTP response read size and socket receive buffer
+WRITE_CHUNK_SIZE = 1024 * 1024  # Device write size, also caps each decompressed block
+FADVISE_INTERVAL = 64 * 1024 * 1024  # Drop written pages from the page cache this often
+DOWNLOAD_TIMEOUT = 30  # Per socket operation
+WRITE_TIMEOUT = 600  # 10 minutes for the whole write
+MAX_REQUEST_THREADS = 4  # Concurrent HTTP requests handled by the server
+KEEPALIVE_TIMEOUT = 10  # Seconds an idle keep-alive connection may hold a request thread
+
+# Global progress tracking - replaced with a new dict on every update so
+# /status can read it without locking (a global rebind is atomic)
 write_progress = {
     'stage': 'idle',  # idle, wiping, downloading, writing, syncing, complete, error
     'percent': 0,
     'message': '',
-    'error': None,
-    'lock': threading.Lock()
+    'error': None
 }
 
+# Serializes progress updates; readers don't take it
+progress_lock = threading.Lock()
 
-def validate_ip(client_ip):
-    """Validate request IP against whitelist"""
-    for allowed_pattern in config['allowed_ips']:
+# Held from queueing a write until it finishes so only one runs at a time
+write_lock = threading.Lock()
+
+# Image writes run on a worker thread so /write-image returns immediately
+write_queue = queue.Queue(maxsize=1)
+
+
+def build_acl(allowed_ips):
+    """Split whitelist into exact addresses and parsed CIDR networks"""
+    exact = set()
+    networks = []
+    for allowed_pattern in allowed_ips:
         if '/' in allowed_pattern:
-            # CIDR notation - simple check
-            network = allowed_pattern.split('/')[0].rsplit('.', 1)[0]
-            if client_ip.startswith(network):
-                return True
+            networks.append(ipaddress.ip_network(allowed_pattern, strict=False))
         else:
-            if client_ip == allowed_pattern:
-                return True
-    return False
+            exact.add(allowed_pattern)
+    return frozenset(exact), networks
+
+
+ALLOWED_IPS, ALLOWED_NETWORKS = build_acl(config['allowed_ips'])
+SHARED_SECRET = config['shared_secret'].encode()
+
+
+def validate_ip(client_ip):
+    """Validate request IP against whitelist"""
+    if client_ip in ALLOWED_IPS:
+        return True
+    try:
+        ip = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return False
+    return any(ip in network for network in ALLOWED_NETWORKS)
 
 
 def update_progress(stage, percent, message, error=None):
-    """Update global progress state (thread-safe)"""
-    with write_progress['lock']:
-        write_progress['stage'] = stage
-        write_progress['percent'] = percent
-        write_progress['message'] = message
-        write_progress['error'] = error
+    """Publish a new global progress snapshot (thread-safe)"""
+    global write_progress
+    with progress_lock:
+        write_progress = {
+            'stage': stage,
+            'percent': percent,
+            'message': message,
+            'error': error
+        }
         print(f"Progress: {stage} - {percent}% - {message}")
 
 
+def open_device(device):
+    """Open block device for writing, preferring O_DIRECT to bypass the page cache"""
+    flags = os.O_WRONLY | os.O_SYNC
+    direct = getattr(os, 'O_DIRECT', 0)
+    if direct:
+        try:
+            return os.open(device, flags | direct), True
+        except OSError as e:
+            print(f'O_DIRECT not supported on {device} ({e}), using buffered writes')
+    return os.open(device, flags), False
+
+
+class WriteTimeout(Exception):
+    """The whole write took longer than WRITE_TIMEOUT"""
+
+
+class DeviceWriter:
+    """Collects data into page-aligned chunks and writes them to a block device"""
+
+    def __init__(self, fd, direct):
+        self.fd = fd
+        self.direct = direct
+        # Anonymous mmap is page-aligned, which O_DIRECT requires
+        self.buf = mmap.mmap(-1, WRITE_CHUNK_SIZE)
+        self.fill = 0
+        self.written = 0
+        self.next_fadvise = FADVISE_INTERVAL
+
+    def write(self, data):
+        """Buffer data, writing out every full chunk"""
+        with memoryview(data) as view:
+            while view:
+                n = min(len(view), WRITE_CHUNK_SIZE - self.fill)
+                self.buf[self.fill:self.fill + n] = view[:n]
+                self.fill += n
+                view = view[n:]
+                if self.fill == WRITE_CHUNK_SIZE:
+                    self.flush()
+
+    def flush(self):
+        """Write buffered data to the device"""
+        if self.direct and self.fill < WRITE_CHUNK_SIZE:
+            # Final short chunk may not be a multiple of the logical block size
+            # (512 or 4096 bytes) - drop O_DIRECT for it
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self.direct = False
+        with memoryview(self.buf) as view:
+            offset = 0
+            while offset < self.fill:
+                offset += os.write(self.fd, view[offset:self.fill])
+        self.written += self.fill
+        self.fill = 0
+
+        # Buffered writes land in the page cache; drop them so a multi-GB
+        # image doesn't evict everything else on a small Pi
+        if not self.direct and self.written >= self.next_fadvise:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            self.next_fadvise = self.written + FADVISE_INTERVAL
+
+    def close(self):
+        """Write any remaining data and release the buffer"""
+        if self.fill:
+            self.flush()
+        self.buf.close()
+
+
+class ZlibDecompressor:
+    """Decompresses a gzip stream in-process and passes it to a DeviceWriter"""
+
+    def __init__(self, writer, zlib_module=zlib):
+        self.writer = writer
+        self.zlib_module = zlib_module
+        self.decomp = zlib_module.decompressobj(31)
+
+    def feed(self, data):
+        """Decompress data, bounding each block to one write chunk"""
+        while data:
+            self.writer.write(self.decomp.decompress(data, WRITE_CHUNK_SIZE))
+            if self.decomp.eof:
+                # Anything after a gzip member is the next member (concatenated
+                # files, parallel compressors); continue with it like gunzip does
+                data = self.decomp.unused_data
+                if data:
+                    self.decomp = self.zlib_module.decompressobj(31)
+            else:
+                data = self.decomp.unconsumed_tail
+
+    def finish(self):
+        """Flush remaining output and check the stream was complete"""
+        self.writer.write(self.decomp.flush())
+        if not self.decomp.eof:
+            raise ValueError('Image download ended before end of gzip stream')
+
+    def close(self):
+        pass
+
+
+class PigzDecompressor:
+    """Decompresses a gzip stream with pigz, writing its output from a second thread"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.error = None
+        # Set when the write is abandoned; the drain thread must not touch the device after
+        self.aborted = threading.Event()
+        self.proc = subprocess.Popen(['pigz', '-d', '-c'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        """Copy pigz output to the device"""
+        buf = bytearray(WRITE_CHUNK_SIZE)
+        view = memoryview(buf)
+        try:
+            while True:
+                n = self.proc.stdout.readinto(view)
+                if not n or self.aborted.is_set():
+                    break
+                self.writer.write(view[:n])
+        except Exception as e:
+            self.error = e
+            # Unblock feed() which may be waiting on a full pipe
+            self.proc.kill()
+
+    def feed(self, data):
+        """Pass compressed data to pigz"""
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            self.finish()
+            raise
+
+    def finish(self):
+        """Wait for pigz to drain and check it succeeded"""
+        self.proc.stdin.close()
+        self.thread.join()
+        self.proc.wait()
+        if self.error:
+            raise self.error
+        if self.proc.returncode != 0:
+            raise ValueError(f'pigz failed with exit code {self.proc.returncode}')
+
+    def close(self):
+        """Stop pigz and wait for the drain thread, so nothing writes after the device is closed"""
+        self.aborted.set()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        # pigz is gone, so its stdout hits EOF and the drain thread exits
+        self.thread.join()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+def make_decompressor(writer):
+    """Pick the fastest available gzip decoder: ISA-L, then pigz, then zlib"""
+    if isal_zlib is not None:
+        return ZlibDecompressor(writer, isal_zlib)
+    if shutil.which('pigz'):
+        return PigzDecompressor(writer)
+    return ZlibDecompressor(writer)
+
+
+def set_recv_buffer(resp, size):
+    """Enlarge the socket receive buffer behind an HTTP response"""
+    try:
+        resp.fp.raw._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except (AttributeError, OSError) as e:
+        print(f'Could not set receive buffer size: {e}')
+
+
+def stream_image(image_url, device):
+    """Download image and write it to device, decompressing gzip on the fly"""
+    deadline = time.monotonic() + WRITE_TIMEOUT
+    with urllib.request.urlopen(image_url, timeout=DOWNLOAD_TIMEOUT) as resp:
+        total = int(resp.headers.get('Content-Length') or 0)
+        compressed = (image_url.endswith('.gz') or
+                      resp.headers.get_content_type() == 'application/gzip')
+        set_recv_buffer(resp, READ_CHUNK_SIZE)
+
+        # Reused for every read to avoid a per-chunk allocation
+        buf = bytearray(READ_CHUNK_SIZE)
+        view = memoryview(buf)
+
+        fd, direct = open_device(device)
+        writer = DeviceWriter(fd, direct)
+        decomp = make_decompressor(writer) if compressed else None
+        try:
+            received = 0
+            last_percent = None
+            while True:
+                n = resp.readinto(view)
+                if not n:
+                    break
+                received += n
+
+                if decomp:
+                    decomp.feed(view[:n])
+                else:
+                    writer.write(view[:n])
+
+                if time.monotonic() > deadline:
+                    raise WriteTimeout(f'Timeout after {WRITE_TIMEOUT // 60} minutes')
+
+                # Writing stage spans 10-95%
+                percent = 10 + received * 85 // total if total else 10
+                if percent != last_percent:
+                    last_percent = percent
+                    update_progress('writing', percent,
+                                    f'Written {writer.written // (1024 * 1024)} MB to {device}')
+
+            if decomp:
+                decomp.finish()
+            writer.close()
+        finally:
+            if decomp:
+                decomp.close()
+            os.close(fd)
+
+    return writer.written
+
+
+def write_image(device, image_url):
+    """Wipe device and stream image onto it, reporting progress"""
+    try:
+        print(f'Writing image from {image_url} to {device}')
+
+        # Wipe existing partition table (handles existing OS installations)
+        update_progress('wiping', 5, f'Wiping partition table on {device}...')
+        print(f'Wiping partition table on {device}...')
+        try:
+            wipe_result = subprocess.run(
+                ['wipefs', '-a', device],
+                capture_output=True,
+                text=True,
+                timeout=30
+            )
+
+            if wipe_result.returncode != 0:
+                print(f'Warning: wipefs failed, trying dd fallback: {wipe_result.stderr}')
+                raise FileNotFoundError("wipefs failed, using fallback")
+
+        except (FileNotFoundError, OSError) as e:
+            # Buildroot doesn't have wipefs - use dd fallback
+            print(f'wipefs not available ({e}), using dd to wipe partition table')
+            subprocess.run(
+                f'dd if=/dev/zero of={device} bs=1M count=10',
+                shell=True,
+                capture_output=True,
+                timeout=30
+            )
+
+        # Force kernel to re-read partition table
+        print('Refreshing kernel partition table...')
+        try:
+            subprocess.run(['partprobe', device], capture_output=True, timeout=10)
+        except:
+            # partprobe might not exist, try blockdev
+            try:
+                subprocess.run(['blockdev', '--rereadpt', device], capture_output=True, timeout=10)
+            except:
+                # If both fail, at least sync
+                subprocess.run(['sync'], capture_output=True, timeout=5)
+
+        update_progress('writing', 10, f'Partition table wiped, downloading and writing image...')
+        print('Partition table wiped, writing image...')
+
+        # Download, decompress and write image in-process
+        written = stream_image(image_url, device)
+
+        update_progress('syncing', 95, f'Image written, synchronizing filesystem...')
+        print(f'Successfully wrote {written} bytes to {device}')
+
+        # Sync filesystems
+        subprocess.run(['sync'], check=True)
+
+        update_progress('complete', 100, f'Image successfully written to {device}')
+
+    except WriteTimeout as e:
+        update_progress('error', 0, 'Write operation timed out', error=str(e))
+        print(f'Error writing image: {e}')
+    except (socket.timeout, TimeoutError):
+        # Socket read timeout (socket.timeout is TimeoutError on Python 3.10+)
+        error = f'No data from server for {DOWNLOAD_TIMEOUT} seconds'
+        update_progress('error', 0, 'Image download stalled', error=error)
+        print(f'Error writing image: {error}')
+    except Exception as e:
+        update_progress('error', 0, f'Error: {str(e)}', error=str(e))
+        print(f'Error writing image: {e}')
+
+
+def write_worker():
+    """Run queued image writes one at a time"""
+    while True:
+        job = write_queue.get()
+        try:
+            write_image(job['device'], job['image_url'])
+        finally:
+            # Acquired by the handler that queued the job
+            write_lock.release()
+            write_queue.task_done()
+
+
 class NetbootImageHandler(BaseHTTPRequestHandler):
     """HTTP request handler for write-to-disk requests"""
     
+    # Keep connections open between /status polls
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    
     def log_message(self, format, *args):
         """Custom logging"""
         print(f"{self.client_address[0]} - {format % args}")
     
     def send_json(self, data, status=200):
         """Send JSON response"""
+        payload = dump_json(data)
         self.send_response(status)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Connection', 'close' if self.close_connection else 'keep-alive')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(payload)
     
     def do_GET(self):
         """Handle GET requests"""
         if self.path == '/health':
             self.send_json({'status': 'ok', 'service': 'netboot-imager'})
         elif self.path == '/status':
-            # Return current write progress
-            with write_progress['lock']:
-                self.send_json({
-                    'stage': write_progress['stage'],
-                    'percent': write_progress['percent'],
-                    'message': write_progress['message'],
-                    'error': write_progress['error']
-                })
+            # Return current write progress snapshot
+            self.send_json(write_progress)
         else:
             self.send_json({'error': 'Not found'}, 404)
     
@@ -98,20 +467,25 @@ class NetbootImageHandler(BaseHTTPRequestHandler):
         if self.path == '/write-image':
             self.handle_write_image()
         else:
+            # Body is left unread, so the connection can't be reused
+            self.close_connection = True
             self.send_json({'error': 'Not found'}, 404)
     
     def handle_write_image(self):
-        """Write image to local disk"""
+        """Validate request and queue image write to local disk"""
         client_ip = self.client_address[0]
         
         # Validate IP
         if not validate_ip(client_ip):
+            self.close_connection = True
             self.send_json({'error': f'Unauthorized IP: {client_ip}'}, 403)
             return
         
         # Validate token
-        token = self.headers.get('X-Netboot-Token')
-        if token != config['shared_secret']:
+        token = self.headers.get('X-Netboot-Token') or ''
+        # Constant-time comparison so response timing doesn't leak the secret
+        if not hmac.compare_digest(token.encode(), SHARED_SECRET):
+            self.close_connection = True
             self.send_json({'error': 'Invalid token'}, 403)
             return
         
@@ -119,7 +493,7 @@ class NetbootImageHandler(BaseHTTPRequestHandler):
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
         try:
-            data = json.loads(body.decode())
+            data = load_json(body)
         except:
             self.send_json({'error': 'Invalid JSON'}, 400)
             return
@@ -137,100 +511,54 @@ class NetbootImageHandler(BaseHTTPRequestHandler):
             self.send_json({'error': f'Invalid device. Must be one of: {valid_devices}'}, 400)
             return
         
+        # Only one write at a time; /status and /health stay available
+        if not write_lock.acquire(blocking=False):
+            self.send_json({'error': 'A write is already in progress'}, 409)
+            return
+        
+        # Reset progress before returning so pollers don't see the last result
+        update_progress('wiping', 0, f'Preparing to write image to {device}')
         try:
-            # Reset progress
-            update_progress('wiping', 0, f'Preparing to write image to {device}')
-            
-            print(f'Writing image from {image_url} to {device}')
-            
-            # Wipe existing partition table (handles existing OS installations)
-            update_progress('wiping', 5, f'Wiping partition table on {device}...')
-            print(f'Wiping partition table on {device}...')
-            try:
-                wipe_result = subprocess.run(
-                    ['wipefs', '-a', device],
-                    capture_output=True,
-                    text=True,
-                    timeout=30
-                )
-                
-                if wipe_result.returncode != 0:
-                    print(f'Warning: wipefs failed, trying dd fallback: {wipe_result.stderr}')
-                    raise FileNotFoundError("wipefs failed, using fallback")
-                    
-            except (FileNotFoundError, OSError) as e:
-                # Buildroot doesn't have wipefs - use dd fallback
-                print(f'wipefs not available ({e}), using dd to wipe partition table')
-                subprocess.run(
-                    f'dd if=/dev/zero of={device} bs=1M count=10',
-                    shell=True,
-                    capture_output=True,
-                    timeout=30
-                )
-            
-            # Force kernel to re-read partition table
-            print('Refreshing kernel partition table...')
-            try:
-                subprocess.run(['partprobe', device], capture_output=True, timeout=10)
-            except:
-                # partprobe might not exist, try blockdev
-                try:
-                    subprocess.run(['blockdev', '--rereadpt', device], capture_output=True, timeout=10)
-                except:
-                    # If both fail, at least sync
-                    subprocess.run(['sync'], capture_output=True, timeout=5)
-            
-            update_progress('writing', 10, f'Partition table wiped, downloading and writing image...')
-            print('Partition table wiped, writing image...')
-            
-            # Download and write image  
-            # Simplified dd flags for BusyBox compatibility
-            if image_url.endswith('.gz'):
-                cmd = f'curl -s "{image_url}" | gunzip | dd of={device} bs=4M'
-            else:
-                cmd = f'curl -s "{image_url}" | dd of={device} bs=4M'
-            
-            # Execute dd command
-            result = subprocess.run(
-                cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minute timeout
-            )
-            
-            if result.returncode == 0:
-                update_progress('syncing', 95, f'Image written, synchronizing filesystem...')
-                print(f'Successfully wrote image to {device}')
-                
-                # Sync filesystems
-                subprocess.run(['sync'], check=True)
-                
-                update_progress('complete', 100, f'Image successfully written to {device}')
-                
-                self.send_json({
-                    'success': True,
-                    'message': f'Image successfully written to {device}',
-                    'output': result.stderr  # dd writes progress to stderr
-                })
-            else:
-                update_progress('error', 0, f'Write failed', error=result.stderr)
-                print(f'Write failed: {result.stderr}')
-                self.send_json({'error': result.stderr}, 500)
-                
-        except subprocess.TimeoutExpired:
-            update_progress('error', 0, 'Write operation timed out', error='Timeout after 10 minutes')
-            self.send_json({'error': 'Write operation timed out after 10 minutes'}, 504)
-        except Exception as e:
-            update_progress('error', 0, f'Error: {str(e)}', error=str(e))
-            print(f'Error writing image: {e}')
-            self.send_json({'error': str(e)}, 500)
+            write_queue.put_nowait({'device': device, 'image_url': image_url})
+        except queue.Full:
+            write_lock.release()
+            self.send_json({'error': 'A write is already in progress'}, 409)
+            return
+        
+        self.send_json({
+            'status': 'queued',
+            'message': f'Writing image to {device}, poll /status for progress'
+        }, 202)
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """Threaded HTTP server with a cap on concurrent request threads"""
+    
+    def __init__(self, server_address, handler_class, max_threads=MAX_REQUEST_THREADS):
+        super().__init__(server_address, handler_class)
+        self.thread_slots = threading.BoundedSemaphore(max_threads)
+    
+    def process_request(self, request, client_address):
+        """Wait for a free slot before starting a request thread"""
+        self.thread_slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.thread_slots.release()
+            raise
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.thread_slots.release()
 
 
 def run_server():
     """Run the HTTP server"""
     port = config.get('port', 8888)
-    server = HTTPServer(('0.0.0.0', port), NetbootImageHandler)
+    server = BoundedThreadingHTTPServer(('0.0.0.0', port), NetbootImageHandler)
+    threading.Thread(target=write_worker, daemon=True).start()
     print(f'Netboot Image Writer Service starting on port {port}')
     print(f'Allowed IPs: {config["allowed_ips"]}')
     try:
@@ -3,79 +3,196 @@ pi-netboot-server Web UI Backend
 Flask API for managing netboot images and connected devices
 """
 
-from flask import Flask, jsonify, request, send_from_directory, send_file
+from flask import Flask, Response, jsonify, request, send_from_directory, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.formparser import MultiPartParser
+from werkzeug.http import parse_options_header
+from werkzeug.wsgi import FileWrapper, wrap_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
 import os
+import bisect
+import errno
+import shutil
+import socket
 import json
+import mmap
+import tempfile
+import threading
+import time
+import zlib
 from pathlib import Path
 from datetime import datetime
-import re
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (3-5x faster than the stdlib json)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Build the body as bytes directly instead of going through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default),
+                                        mimetype=self.mimetype)
+
 
 app = Flask(__name__, static_folder='static')
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 CORS(app)
+# Hand image downloads to a fronting server that honours X-Sendfile
+# (Apache mod_xsendfile, lighttpd); nginx needs X-Accel-Redirect instead
+app.use_x_sendfile = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # Configuration
 IMAGES_DIR = Path('/images')
 ACTIVE_LINK = IMAGES_DIR / 'active-rootfs'
 GITHUB_REPO = 'openseastack/openseastack'  # Update with actual repo
+RELEASE_CACHE_TTL = 60  # Seconds before revalidating the latest release with GitHub
+# Release asset formats the download and write-to-disk paths handle, in order of preference
+RELEASE_IMAGE_SUFFIXES = ('.img.gz', '.img')
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Multipart parser and upload write buffer size
+SEND_CHUNK_SIZE = 1024 * 1024  # Read size when the WSGI server can't sendfile()
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Release download read/write size
+DOWNLOAD_REPORT_INTERVAL = 16 * 1024 * 1024  # Log release download progress this often
+SIZE_MARKER = '.size'  # Per-image file caching its size in MB, written at import
+SIZE_SCAN_WORKERS = 4  # Parallel directory size scans; more doesn't help on a single disk
+HOST_IPS_CACHE_TTL = 30  # Seconds to reuse the host's IP addresses in /api/network/status
 
 # ============================================================================
 # GitHub Release Management
 # ============================================================================
 
+# Shared session so GitHub API calls and release downloads reuse TLS connections
+github_session = requests.Session()
+github_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+github_session.headers['User-Agent'] = 'pi-netboot-server'
+
+# Last release info from GitHub; revalidated with If-None-Match once stale
+_release_cache = {'ts': 0, 'etag': None, 'body': None}
+
+
 @app.route('/api/releases/latest', methods=['GET'])
 def get_latest_release():
-    """Fetch latest GitHub release info"""
+    """Fetch latest GitHub release info (cached for RELEASE_CACHE_TTL seconds)"""
+    if _release_cache['body'] and time.time() - _release_cache['ts'] < RELEASE_CACHE_TTL:
+        return jsonify(_release_cache['body'])
+    
     try:
         url = f'https://api.github.com/repos/{GITHUB_REPO}/releases/latest'
-        response = requests.get(url, timeout=10)
+        headers = {'Accept': 'application/vnd.github+json'}
+        if _release_cache['etag']:
+            headers['If-None-Match'] = _release_cache['etag']
+        response = github_session.get(url, headers=headers, timeout=10)
+        
+        # Not modified - conditional requests don't count against the rate limit
+        if response.status_code == 304 and _release_cache['body']:
+            _release_cache['ts'] = time.time()
+            return jsonify(_release_cache['body'])
+        
         response.raise_for_status()
         
         release = response.json()
         
-        # Find .img.gz asset
+        # Index assets by image suffix, then pick the preferred format
+        assets_by_suffix = {}
+        for asset in release['assets']:
+            for suffix in RELEASE_IMAGE_SUFFIXES:
+                if asset['name'].endswith(suffix):
+                    assets_by_suffix.setdefault(suffix, asset)
+                    break
         img_asset = next(
-            (a for a in release['assets'] if a['name'].endswith('.img.gz')),
+            (assets_by_suffix[s] for s in RELEASE_IMAGE_SUFFIXES if s in assets_by_suffix),
             None
         )
         
-        return jsonify({
+        body = {
             'version': release['tag_name'],
             'name': release['name'],
             'published_at': release['published_at'],
             'changelog': release['body'],
             'download_url': img_asset['browser_download_url'] if img_asset else None,
             'size_mb': round(img_asset['size'] / 1024 / 1024, 1) if img_asset else 0
-        })
+        }
+        _release_cache.update(ts=time.time(), etag=response.headers.get('ETag'), body=body)
+        
+        return jsonify(body)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/images/download', methods=['POST'])
+def download_release():
+    """Download release image from GitHub"""
+    data = request.json
+    url = data.get('url')
+    version = data.get('version')
+    
+    if not url or not version:
+        return jsonify({'error': 'Missing url or version'}), 400
+    
+    if not is_valid_version_name(version):
+        return jsonify({'error': 'Invalid version'}), 400
+    
+    try:
+        version_dir = IMAGES_DIR / version
+        version_dir.mkdir(parents=True, exist_ok=True)
         
         # Download file
-        img_path = version_dir / 'image.img.gz'
+        img_path = version_dir / ('image.img.gz' if url.endswith('.gz') else 'image.img')
         
-        response = requests.get(url, stream=True, timeout=30)
+        response = github_session.get(url, stream=True, timeout=30)
         response.raise_for_status()
         
         total_size = int(response.headers.get('content-length', 0))
         downloaded = 0
+        next_report = DOWNLOAD_REPORT_INTERVAL
         
-        with open(img_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
+        # Unbuffered file: 1 MiB chunks are written as-is without an extra copy
+        with open(img_path, 'wb', buffering=0) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
                     downloaded += len(chunk)
                     # TODO: Emit progress events via SSE or WebSocket
+                    if downloaded >= next_report:
+                        print(f"Downloading {version}: {downloaded // 1048576}/{total_size // 1048576} MB")
+                        next_report += DOWNLOAD_REPORT_INTERVAL
         
         # Extract image
-        subprocess.run(['gunzip', str(img_path)], check=True)
+        if img_path.suffix == '.gz':
+            subprocess.run(['gunzip', str(img_path)], check=True)
         
         # Mount and extract rootfs
         extract_rootfs(version_dir / 'image.img', version_dir / 'rootfs-raw')
         
+        write_size_marker(version_dir)
+        
         return jsonify({'success': True, 'version': version})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -83,41 +200,48 @@ def get_latest_release():
 
 @app.route('/api/images/upload', methods=['POST'])
 def upload_image():
-    """Upload image file from browser"""
-    if 'file' not in request.files:
+    """Upload image file from browser, streaming it straight to disk"""
+    mimetype, options = parse_options_header(request.content_type or '')
+    if mimetype != 'multipart/form-data' or 'boundary' not in options:
         return jsonify({'error': 'No file provided'}), 400
     
-    file = request.files['file']
+    writers = []
     
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    def stream_factory(*args, **kwargs):
+        writer = upload_stream_factory(*args, **kwargs)
+        writers.append(writer)
+        return writer
     
     try:
-        # Generate version name from filename
-        filename = file.filename
-        if filename.endswith('.img.gz'):
-            version_name = filename.replace('.img.gz', '')
-        elif filename.endswith('.img'):
-            version_name = filename.replace('.img', '')
-        elif filename.endswith('.tar.gz'):
-            version_name = filename.replace('.tar.gz', '')
-        else:
-            version_name = filename
+        # Parse the multipart body ourselves so each file part is written (and
+        # gunzipped) as it arrives instead of being spooled to /tmp first
+        parser = MultiPartParser(stream_factory=stream_factory,
+                                 buffer_size=UPLOAD_CHUNK_SIZE)
+        _, files = parser.parse(request.stream, options['boundary'].encode(),
+                                request.content_length)
         
-        # Create version directory
-        version_dir = IMAGES_DIR / version_name
-        version_dir.mkdir(parents=True, exist_ok=True)
+        # Only the 'file' part is used; remove anything written for other file fields
+        file = files.get('file')
+        for writer in writers:
+            if file is None or writer.path != file.stream.path:
+                writer.discard()
         
-        # Save uploaded file
-        saved_path = version_dir / filename
-        file.save(str(saved_path))
+        if file is None:
+            return jsonify({'error': 'No file provided'}), 400
         
-        # If it's compressed, extract it
-        if filename.endswith('.gz'):
-            subprocess.run(['gunzip', str(saved_path)], check=True)
-            img_path = version_dir / filename.replace('.gz', '')
-        else:
-            img_path = saved_path
+        writers = [file.stream]
+        
+        if file.filename == '':
+            file.stream.discard()
+            return jsonify({'error': 'No file selected'}), 400
+        
+        # Finish decompression and close the image file
+        file.stream.close()
+        writers.clear()
+        
+        version_name = get_version_name(file.filename)
+        version_dir = IMAGES_DIR / version_name
+        img_path = file.stream.path
         
         # Extract rootfs if it's an image file
         if img_path.suffix == '.img':
@@ -132,8 +256,17 @@ def upload_image():
                 if extracted and extracted.is_dir():
                     extracted.rename(version_dir / 'rootfs-raw')
         
+        write_size_marker(version_dir)
+        
         return jsonify({'success': True, 'name': version_name})
+    except InvalidUploadName as e:
+        for writer in writers:
+            writer.discard()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
+        # Don't leave a truncated image behind in the version directory
+        for writer in writers:
+            writer.discard()
         return jsonify({'error': str(e)}), 500
 
 
@@ -154,16 +287,18 @@ def import_local_image():
             # Copy directory
             import_name = source.name
             dest_dir = IMAGES_DIR / import_name
-            subprocess.run(['cp', '-r', str(source), str(dest_dir)], check=True)
+            copy_tree(source, dest_dir)
         else:
             # Copy and extract image
             import_name = source.stem.replace('.img', '')
             dest_dir = IMAGES_DIR / import_name
             dest_dir.mkdir(parents=True, exist_ok=True)
             
-            subprocess.run(['cp', str(source), str(dest_dir / 'image.img')], check=True)
+            copy_file(source, dest_dir / 'image.img')
             extract_rootfs(dest_dir / 'image.img', dest_dir / 'rootfs-raw')
         
+        write_size_marker(dest_dir)
+        
         return jsonify({'success': True, 'name': import_name})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -176,15 +311,34 @@ def list_images():
     
     # Check for images in /images directory
     if IMAGES_DIR.exists():
-        for item in IMAGES_DIR.iterdir():
-            if item.is_dir() and item.name != 'active-rootfs':
-                is_active = ACTIVE_LINK.exists() and ACTIVE_LINK.resolve() == (item / 'rootfs-raw').resolve()
-                
-                images.append({
-                    'name': item.name,
-                    'active': is_active,
-                    'size_mb': get_dir_size(item)
-                })
+        # Resolve the active link once and compare each image lexically
+        active_target = ACTIVE_LINK.resolve() if ACTIVE_LINK.is_symlink() else None
+        images_root = IMAGES_DIR.resolve()
+        
+        items = [item for item in IMAGES_DIR.iterdir()
+                 if item.is_dir() and item.name != 'active-rootfs']
+        
+        sizes = [read_size_marker(item) for item in items]
+        
+        # Only images without a size marker need a tree walk; those scans are
+        # independent and bound by disk I/O, so run several in parallel
+        unsized = [i for i, size in enumerate(sizes) if size is None]
+        if len(unsized) == 1:
+            sizes[unsized[0]] = get_dir_size(items[unsized[0]])
+        elif unsized:
+            with ThreadPoolExecutor(max_workers=SIZE_SCAN_WORKERS) as executor:
+                scanned = executor.map(get_dir_size, [items[i] for i in unsized])
+                for i, size in zip(unsized, scanned):
+                    sizes[i] = size
+        
+        for item, size_mb in zip(items, sizes):
+            is_active = active_target == images_root / item.name / 'rootfs-raw'
+            
+            images.append({
+                'name': item.name,
+                'active': is_active,
+                'size_mb': size_mb
+            })
     
     # Also check for direct mount at /nfs/rootfs (common setup)
     direct_rootfs = Path('/nfs/rootfs')
@@ -241,103 +395,246 @@ def activate_image():
 # ============================================================================
 
 BOOT_HISTORY_FILE = '/tmp/boot-history.json'
+BOOT_LOG_FILE = '/var/log/netboot/dnsmasq.log'
+# Possible dnsmasq lease file locations, depending on distro/config
+LEASE_FILE_PATHS = (
+    '/var/lib/misc/dnsmasq.leases',
+    '/var/lib/dnsmasq/dnsmasq.leases',
+    '/tmp/dnsmasq.leases'
+)
+BOOT_WATCH_INTERVAL = 2  # Seconds between checks of the dnsmasq log for new boot events
+BOOT_LOG_MAX_READ = 1024 * 1024  # Beyond this much unread log, only the last 500 lines are parsed
+TFTP_MATCH_WINDOW = 30  # Seconds after a PXE boot in which its TFTP transfer is expected
+
+# Keep-alive connections to the netboot-imager service on each Pi (one pool per Pi)
+pi_session = requests.Session()
+pi_session.mount('http://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=8,
+    max_retries=0
+))
+
+# PXE format: "Dec 24 23:52:53 dnsmasq-dhcp[34]: 3274722395 PXE(col0) 2c:cf:67:7c:d4:67 proxy"
+# TFTP format: "Dec 26 17:39:48 dnsmasq-tftp[26]: sent /tftpboot/start4.elf to 10.10.200.180"
+MAC_CHARS = frozenset('0123456789abcdef:')
+IPV4_CHARS = frozenset('0123456789.')
+
+MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+def is_mac(s):
+    """True for a lowercase colon-separated MAC address as logged by dnsmasq"""
+    return MAC_CHARS.issuperset(s)
+
+
+def is_ipv4(s):
+    """True for a dotted-quad address as logged by dnsmasq"""
+    return s != '' and IPV4_CHARS.issuperset(s)
+
+
+@lru_cache(maxsize=1024)
+def parse_log_timestamp(year, timestamp_str):
+    """Parse a dnsmasq log timestamp ("Dec 24 23:52:53") without strptime"""
+    try:
+        month = MONTHS[timestamp_str[:3]]
+        day, clock = timestamp_str[3:].split()
+        hour, minute, second = clock.split(':')
+        return datetime(year, month, int(day), int(hour), int(minute), int(second))
+    except (KeyError, ValueError):
+        # Non-English month names etc.
+        return datetime.strptime(f"{year} {timestamp_str}", "%Y %b %d %H:%M:%S")
+
+
+# Parsed boot history, reused while the file's mtime is unchanged. Request threads
+# share the cached dict, so it is never modified in place; parse_boot_events works
+# on a copy and publishes it through save_boot_history.
+_history_cache = {'mtime': None, 'data': None}
 
 
 def load_boot_history():
-    """Load boot history from JSON file"""
-    if os.path.exists(BOOT_HISTORY_FILE):
-        try:
-            with open(BOOT_HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+    """Load boot history from JSON file (treat the result as read-only)"""
+    try:
+        mtime = os.stat(BOOT_HISTORY_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    
+    if mtime == _history_cache['mtime']:
+        return _history_cache['data']
+    
+    try:
+        with open(BOOT_HISTORY_FILE, 'rb') as f:
+            data = f.read()
+        history = orjson.loads(data) if orjson is not None else json.loads(data)
+    except:
+        return {}
+    
+    _history_cache['mtime'] = mtime
+    _history_cache['data'] = history
+    return history
 
 
 def save_boot_history(history):
-    """Save boot history to JSON file"""
+    """Save boot history to JSON file (atomically, so readers never see a partial file)"""
+    if orjson is not None:
+        data = orjson.dumps(history)
+    else:
+        data = json.dumps(history, separators=(',', ':')).encode()
+    
+    tmp_file = BOOT_HISTORY_FILE + '.tmp'
     try:
-        with open(BOOT_HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, BOOT_HISTORY_FILE)
+        _history_cache['mtime'] = os.stat(BOOT_HISTORY_FILE).st_mtime_ns
+        _history_cache['data'] = history
     except Exception as e:
+        _history_cache['mtime'] = None
         print(f"Error saving boot history: {e}")
 
 
+# mac -> (last_boot ISO string, epoch seconds), so each last_boot is parsed only once
+_last_boot_ts = {}
+
+
+def last_boot_timestamp(mac, last_boot):
+    """Epoch seconds of a history entry's ISO last_boot"""
+    cached = _last_boot_ts.get(mac)
+    if cached is None or cached[0] != last_boot:
+        cached = (last_boot, datetime.fromisoformat(last_boot).timestamp())
+        _last_boot_ts[mac] = cached
+    return cached[1]
+
+
+def read_new_log_lines(path, cursor):
+    """Lines appended to path since cursor, and the cursor to resume from next time"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        start = cursor.get('offset', 0) if cursor else 0
+        
+        if (not cursor or cursor.get('inode') != st.st_ino or start > st.st_size
+                or st.st_size - start > BOOT_LOG_MAX_READ):
+            # First run, rotated/truncated log, or too far behind: recent lines only
+            lines = tail_lines(path, 500)
+            return lines, {'inode': st.st_ino, 'offset': st.st_size}
+        
+        data = os.pread(fd, st.st_size - start, start)
+    finally:
+        os.close(fd)
+    
+    # Leave a partially written last line for the next pass
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].decode('utf-8', errors='replace').splitlines()
+    return lines, {'inode': st.st_ino, 'offset': start + end}
+
+
+# Log parser state kept between passes: where the last pass stopped reading, and
+# recorded boots whose TFTP transfer (and so IP) may only show up in a later pass
+_boot_log_state = {'cursor': None, 'pending': []}
+
+
 def parse_boot_events():
     """Parse dnsmasq logs for PXE boot events and update boot history"""
-    log_file = '/var/log/netboot/dnsmasq.log'
+    log_file = BOOT_LOG_FILE
     
     if not os.path.exists(log_file):
         return
     
-    history = load_boot_history()
+    # Copy so readers of the cached history never see a half-updated dict
+    history = {mac: dict(entry) for mac, entry in load_boot_history().items()}
     
     try:
-        # Read last 500 lines to capture recent boot events
-        result = subprocess.run(['tail', '-n', '500', log_file], 
-                              capture_output=True, text=True, timeout=5)
-        
-        lines = result.stdout.split('\n')
-        
-        # Parse PXE boot events and TFTP transfers
-        # PXE format: "Dec 24 23:52:53 dnsmasq-dhcp[34]: 3274722395 PXE(col0) 2c:cf:67:7c:d4:67 proxy"
-        pxe_pattern = re.compile(r'(\w+ \d+ \d+:\d+:\d+).*PXE\([^)]+\)\s+([0-9a-f:]+)\s+proxy')
-        # TFTP format: "Dec 26 17:39:48 dnsmasq-tftp[26]: sent /tftpboot/start4.elf to 10.10.200.180"
-        tftp_pattern = re.compile(r'(\w+ \d+ \d+:\d+:\d+).*sent .* to ([0-9.]+)')
+        # Only look at log lines added since the last pass
+        lines, cursor = read_new_log_lines(log_file, _boot_log_state['cursor'])
+        _boot_log_state['cursor'] = cursor
+        if not lines:
+            return
         
         # Build a time-ordered list of events
         boot_events = []
         tftp_transfers = []
         
+        # dnsmasq timestamps carry no year
+        current_year = datetime.now().year
+        
         for line in lines:
-            # Match PXE boot events
-            pxe_match = pxe_pattern.search(line)
-            if pxe_match:
-                timestamp_str = pxe_match.group(1)
-                mac = pxe_match.group(2).lower()
-                
-                # Parse timestamp
-                try:
-                    current_year = datetime.now().year
-                    timestamp = datetime.strptime(f"{current_year} {timestamp_str}", "%Y %b %d %H:%M:%S")
-                except:
-                    timestamp = datetime.now()
-                
-                boot_events.append({
-                    'time': timestamp,
-                    'mac': mac
-                })
+            # Cheap substring checks first; most dnsmasq lines match neither pattern
+            if len(line) < 16 or line[3] != ' ' or line[15] != ' ':
+                # Every dnsmasq line starts with a fixed-width "Mmm dd hh:mm:ss" timestamp
+                continue
             
-            # Match TFTP transfers (these come after PXE and contain the IP)
-            tftp_match = tftp_pattern.search(line)
-            if tftp_match:
-                timestamp_str = tftp_match.group(1)
-                ip = tftp_match.group(2)
-                
-                try:
-                    current_year = datetime.now().year
-                    timestamp = datetime.strptime(f"{current_year} {timestamp_str}", "%Y %b %d %H:%M:%S")
-                except:
-                    timestamp = datetime.now()
-                
-                tftp_transfers.append({
-                    'time': timestamp,
-                    'ip': ip
-                })
+            if 'PXE(' in line:
+                # PXE boot events: "<timestamp> dnsmasq-dhcp[..]: <xid> PXE(<iface>) <mac> proxy"
+                fields = line.partition(' PXE(')[2].partition(') ')[2].split(None, 2)
+                if len(fields) >= 2 and fields[1] == 'proxy' and is_mac(fields[0]):
+                    timestamp_str = line[:15]
+                    mac = fields[0]
+                    
+                    # Parse timestamp
+                    try:
+                        timestamp = parse_log_timestamp(current_year, timestamp_str)
+                    except ValueError:
+                        timestamp = datetime.now()
+                    
+                    # dnsmasq logs several identical PXE lines per boot request
+                    if boot_events and boot_events[-1]['mac'] == mac and boot_events[-1]['time'] == timestamp:
+                        continue
+                    
+                    boot_events.append({
+                        'time': timestamp,
+                        'mac': mac
+                    })
+            
+            elif ' sent ' in line and ' to ' in line:
+                # TFTP transfers (these come after PXE and contain the IP): "... sent <path> to <ip>"
+                fields = line.rpartition(' to ')[2].split(None, 1)
+                if fields and is_ipv4(fields[0]):
+                    timestamp_str = line[:15]
+                    ip = fields[0]
+                    
+                    try:
+                        timestamp = parse_log_timestamp(current_year, timestamp_str)
+                    except ValueError:
+                        timestamp = datetime.now()
+                    
+                    tftp_transfers.append({
+                        'time': timestamp.timestamp(),
+                        'ip': ip
+                    })
         
         # Correlate PXE boots with TFTP transfers
         # TFTP transfers happen within ~30 seconds after PXE boot
+        tftp_transfers.sort(key=lambda t: t['time'])
+        tftp_times = [t['time'] for t in tftp_transfers]
+        
+        def match_tftp(boot_ts):
+            """IP of the first TFTP transfer at or after boot_ts, if within the window"""
+            i = bisect.bisect_left(tftp_times, boot_ts)
+            if i < len(tftp_times) and tftp_times[i] - boot_ts <= TFTP_MATCH_WINDOW:
+                return tftp_transfers[i]['ip']
+            return None
+        
+        changed = False
+        pending = []
+        
+        # Boots recorded by earlier passes whose TFTP transfer hadn't been logged yet
+        for mac, timestamp_iso, boot_ts in _boot_log_state['pending']:
+            entry = history.get(mac)
+            if entry is None or entry.get('last_boot') != timestamp_iso:
+                continue
+            matching_ip = match_tftp(boot_ts)
+            if matching_ip:
+                entry['last_ip'] = matching_ip
+                changed = True
+            else:
+                pending.append((mac, timestamp_iso, boot_ts))
+        
         for boot in boot_events:
             mac = boot['mac']
             boot_time = boot['time']
-            
-            # Find TFTP transfers within 30 seconds after this boot
-            matching_ip = None
-            for tftp in tftp_transfers:
-                time_diff = (tftp['time'] - boot_time).total_seconds()
-                if 0 <= time_diff <= 30:
-                    matching_ip = tftp['ip']
-                    break
+            boot_ts = boot_time.timestamp()
+            matching_ip = match_tftp(boot_ts)
             
             # Update or create boot history entry
             timestamp_iso = boot_time.isoformat()
@@ -351,23 +648,88 @@ def parse_boot_events():
             else:
                 # Only count as new boot if it's been more than 2 minutes since last boot
                 try:
-                    last_boot = datetime.fromisoformat(history[mac]['last_boot'])
-                    if (boot_time - last_boot).total_seconds() > 120:
+                    if boot_ts - last_boot_timestamp(mac, history[mac]['last_boot']) > 120:
                         history[mac]['boot_count'] += 1
                         history[mac]['last_boot'] = timestamp_iso
                         if matching_ip:
                             history[mac]['last_ip'] = matching_ip
+                    else:
+                        continue
                 except:
                     history[mac]['last_boot'] = timestamp_iso
                     if matching_ip:
                         history[mac]['last_ip'] = matching_ip
+            
+            changed = True
+            if not matching_ip:
+                pending.append((mac, timestamp_iso, boot_ts))
         
-        save_boot_history(history)
+        # Give up on a boot's IP once its TFTP window has passed (with slack for polling)
+        horizon = time.time() - 2 * TFTP_MATCH_WINDOW
+        _boot_log_state['pending'] = [boot for boot in pending if boot[2] >= horizon]
+        
+        if changed:
+            save_boot_history(history)
     except Exception as e:
         print(f"Error parsing boot events: {e}")
 
 
+_boot_watcher_lock = threading.Lock()
+_boot_watcher_started = False
+
+
+def watch_boot_log():
+    """Re-parse boot events whenever the dnsmasq log changes"""
+    last_state = None
+    while True:
+        try:
+            st = os.stat(BOOT_LOG_FILE)
+            state = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            state = None
+        
+        if state is not None and state != last_state:
+            parse_boot_events()
+        last_state = state
+        time.sleep(BOOT_WATCH_INTERVAL)
+
+
+def start_boot_watcher():
+    """Start the boot log watcher thread once per process"""
+    global _boot_watcher_started
+    with _boot_watcher_lock:
+        if _boot_watcher_started:
+            return
+        _boot_watcher_started = True
+    
+    # Populate history for the first request; the thread keeps it current
+    parse_boot_events()
+    threading.Thread(target=watch_boot_log, daemon=True).start()
+
+
+# Active image name, reused until the active link or /nfs/rootfs changes
+_active_image_cache = {'key': None, 'name': None}
+
+
+def stat_key(path):
+    """(inode, mtime) of path without following symlinks, or None if missing"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
 def get_active_image_name():
+    """Get the name of the currently active image (cached)"""
+    key = (stat_key(ACTIVE_LINK), os.path.exists(ACTIVE_LINK), stat_key('/nfs/rootfs'))
+    if key != _active_image_cache['key']:
+        _active_image_cache['name'] = find_active_image_name()
+        _active_image_cache['key'] = key
+    return _active_image_cache['name']
+
+
+def find_active_image_name():
     """Get the name of the currently active image"""
     try:
         # First check if active-rootfs symlink exists in /images
@@ -387,12 +749,35 @@ def get_active_image_name():
     
     return None
 
+
+# Lease file found on a previous request; the location is fixed per deployment
+_leases_file_cache = {'path': None}
+
+
+def read_lease_lines():
+    """Raw lines of the dnsmasq lease file, locating it only on first use or if it moved"""
+    path = _leases_file_cache['path']
+    if path is None:
+        path = next((p for p in LEASE_FILE_PATHS if os.path.exists(p)), None)
+        if path is None:
+            return []
+        _leases_file_cache['path'] = path
+    
+    try:
+        # Leases are a few dozen ASCII bytes each; split as bytes and decode only used fields
+        return Path(path).read_bytes().split(b'\n')
+    except FileNotFoundError:
+        # Look for it again next time
+        _leases_file_cache['path'] = None
+        return []
+
+
 @app.route('/api/devices', methods=['GET'])
 def list_devices():
     """List connected Pis with boot history and active image info"""
     try:
-        # Update boot history from logs
-        parse_boot_events()
+        # Boot history is kept up to date by the watcher thread
+        start_boot_watcher()
         
         # Load boot history
         boot_history = load_boot_history()
@@ -400,51 +785,40 @@ def list_devices():
         # Get active image name
         active_image = get_active_image_name()
         
-        # Try multiple possible lease file locations
-        possible_paths = [
-            '/var/lib/misc/dnsmasq.leases',
-            '/var/lib/dnsmasq/dnsmasq.leases',
-            '/tmp/dnsmasq.leases'
-        ]
-        
-        leases_file = None
-        for path in possible_paths:
-            if os.path.exists(path):
-                leases_file = path
-                break
-        
         # Build device list from leases
         devices = []
         
-        if leases_file and os.path.exists(leases_file):
-            with open(leases_file, 'r') as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) >= 4:
-                        mac = parts[1].lower()
-                        device = {
-                            'ip': parts[2],
-                            'mac': mac,
-                            'hostname': parts[3] if len(parts) > 3 else 'unknown'
-                        }
-                        
-                        # Merge boot history if available
-                        if mac in boot_history:
-                            device['last_boot'] = boot_history[mac].get('last_boot')
-                            device['boot_count'] = boot_history[mac].get('boot_count', 0)
-                        else:
-                            device['last_boot'] = None
-                            device['boot_count'] = 0
-                        
-                        # Add active image
-                        device['image'] = active_image
-                        
-                        devices.append(device)
+        seen = set()
+        
+        for line in read_lease_lines():
+            parts = line.split()
+            if len(parts) >= 4:
+                mac = parts[1].decode('ascii', 'replace').lower()
+                device = {
+                    'ip': parts[2].decode('ascii', 'replace'),
+                    'mac': mac,
+                    'hostname': parts[3].decode('utf-8', 'replace')
+                }
+                
+                # Merge boot history if available
+                boot_data = boot_history.get(mac)
+                if boot_data is not None:
+                    device['last_boot'] = boot_data.get('last_boot')
+                    device['boot_count'] = boot_data.get('boot_count', 0)
+                else:
+                    device['last_boot'] = None
+                    device['boot_count'] = 0
+                
+                # Add active image
+                device['image'] = active_image
+                
+                devices.append(device)
+                seen.add(mac)
         
         # Also include devices from boot history that may not have current leases
         for mac, boot_data in boot_history.items():
             # Check if this MAC is already in devices list
-            if not any(d['mac'] == mac for d in devices):
+            if mac not in seen:
                 devices.append({
                     'ip': boot_data.get('last_ip', 'unknown'),
                     'mac': mac,
@@ -474,9 +848,7 @@ def get_logs():
             if os.path.exists(log_path):
                 try:
                     # Get last 50 lines
-                    result = subprocess.run(['tail', '-n', '50', log_path], 
-                                          capture_output=True, text=True, timeout=5)
-                    logs[service] = result.stdout
+                    logs[service] = ''.join(f"{line}\n" for line in tail_lines(log_path, 50))
                 except:
                     logs[service] = f"Error reading {log_path}"
             else:
@@ -529,7 +901,7 @@ def write_to_disk(ip):
         # Send request to Pi's HTTP service
         pi_service_url = f'http://{ip}:8888/write-image'
         
-        response = requests.post(
+        response = pi_session.post(
             pi_service_url,
             json={
                 'device': device,
@@ -539,11 +911,11 @@ def write_to_disk(ip):
             headers={
                 'X-Netboot-Token': shared_secret
             },
-            timeout=300  # 5 minute timeout for large images
+            timeout=10  # Write is queued on the Pi; progress comes from /status
         )
         
-        if response.status_code == 200:
-            return jsonify(response.json())
+        if response.ok:
+            return jsonify(response.json()), response.status_code
         else:
             error_msg = response.json().get('error', 'Unknown error')
             return jsonify({'error': f'Pi service error: {error_msg}'}), response.status_code
@@ -551,7 +923,7 @@ def write_to_disk(ip):
     except requests.exceptions.ConnectionError:
         return jsonify({'error': 'Cannot connect to Pi service. Ensure the netboot-imager service is running on the Pi.'}), 503
     except requests.exceptions.Timeout:
-        return jsonify({'error': 'Write operation timed out after 5 minutes'}), 504
+        return jsonify({'error': 'Timed out waiting for Pi service to accept write request'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -561,9 +933,9 @@ def get_device_status(ip):
     """Proxy status requests to Pi to avoid CORS issues"""
     try:
         # Poll Pi's status endpoint
-        response = requests.get(f'http://{ip}:8888/status', timeout=2)
+        response = pi_session.get(f'http://{ip}:8888/status', timeout=(1, 2))
         return jsonify(response.json())
-    except requests.RequestException as e:
+    except (requests.RequestException, ValueError):
         # Pi might be offline or rebooting
         return jsonify({
             'stage': 'idle',
@@ -589,20 +961,10 @@ def download_image(image_name):
         
         if img_gz_file:
             # Serve compressed image (Pi will decompress)
-            return send_file(
-                img_gz_file,
-                mimetype='application/gzip',
-                as_attachment=True,
-                download_name=img_gz_file.name
-            )
+            return send_image_file(img_gz_file, 'application/gzip')
         elif img_file:
             # Serve uncompressed image
-            return send_file(
-                img_file,
-                mimetype='application/octet-stream',
-                as_attachment=True,
-                download_name=img_file.name
-            )
+            return send_image_file(img_file, 'application/octet-stream')
         else:
             return jsonify({'error': 'Image file (.img or .img.gz) not found'}), 404
             
@@ -696,11 +1058,13 @@ def network_status():
         current_mode = os.environ.get('DHCP_MODE', 'proxy')
         
         # Get server IP and subnet by reading dnsmasq log
-        result = subprocess.run(['tail', '-5', '/var/log/netboot/dnsmasq.log'], 
-                              capture_output=True, text=True, timeout=5)
+        try:
+            lines = tail_lines('/var/log/netboot/dnsmasq.log', 5)
+        except OSError:
+            lines = []
         
         subnet = None
-        for line in result.stdout.split('\n'):
+        for line in lines:
             if 'proxy on subnet' in line or 'DHCP, IP range' in line:
                 # Extract subnet from log line
                 parts = line.split('subnet')
@@ -711,9 +1075,7 @@ def network_status():
         # Get server IP from environment or detect
         server_ip = os.environ.get('SERVER_IP')
         if not server_ip:
-            ip_result = subprocess.run(['hostname', '-I'], 
-                                      capture_output=True, text=True, timeout=5)
-            ips = ip_result.stdout.strip().split()
+            ips = get_host_ips(int(time.time() // HOST_IPS_CACHE_TTL))
             # Prefer 10.10.200.x
             server_ip = next((ip for ip in ips if ip.startswith('10.10.200.')), 
                            next((ip for ip in ips if ip.startswith('10.')),  
@@ -728,10 +1090,28 @@ def network_status():
         return jsonify({'error': str(e)}), 500
 
 
+@lru_cache(maxsize=1)
+def get_host_ips(ttl_bucket):
+    """Host's non-loopback IPv4 addresses (like `hostname -I`); cached per TTL bucket"""
+    if psutil is None:
+        result = subprocess.run(['hostname', '-I'], capture_output=True, text=True, timeout=5)
+        return tuple(result.stdout.split())
+    
+    return tuple(
+        addr.address
+        for addrs in psutil.net_if_addrs().values()
+        for addr in addrs
+        if addr.family == socket.AF_INET and not addr.address.startswith('127.')
+    )
+
+
 @app.route('/api/network/interfaces', methods=['GET'])
 def list_interfaces():
     """List available network interfaces with IPs"""
     try:
+        if psutil is not None:
+            return jsonify({'interfaces': read_interfaces()})
+        
         result = subprocess.run(['ip', '-j', 'addr', 'show'], 
                               capture_output=True, text=True, timeout=5)
         
@@ -763,6 +1143,30 @@ def list_interfaces():
         return jsonify({'error': str(e), 'interfaces': []}), 500
 
 
+def read_interfaces():
+    """Up interfaces and their first non-loopback IPv4 via psutil (no ip fork)"""
+    interfaces = []
+    
+    for name, addrs in psutil.net_if_addrs().items():
+        # Match `ip`'s operstate rather than psutil's IFF_UP flag
+        try:
+            with open(f'/sys/class/net/{name}/operstate') as f:
+                if f.read().strip() != 'up':
+                    continue
+        except OSError:
+            continue
+        
+        for addr in addrs:
+            if addr.family == socket.AF_INET and not addr.address.startswith('127.'):
+                interfaces.append({
+                    'name': name,
+                    'ip': addr.address
+                })
+                break
+    
+    return interfaces
+
+
 @app.route('/api/network/mode', methods=['POST'])
 def set_dhcp_mode():
     """Switch DHCP mode (requires container restart)"""
@@ -859,20 +1263,269 @@ def browse_directory():
 # Helper Functions
 # ============================================================================
 
+def tail_lines(path, n_lines):
+    """Return the last n_lines of a file via mmap; only the trailing pages get read"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+            # Skip the file's final newline, then walk back n_lines line starts
+            pos = len(mm)
+            end = pos - 1
+            for _ in range(n_lines):
+                end = mm.rfind(b'\n', 0, end)
+                if end < 0:
+                    pos = 0
+                    break
+                pos = end + 1
+            data = mm[pos:]
+    
+    return data.decode('utf-8', errors='replace').splitlines()[-n_lines:]
+
+
+def is_valid_version_name(name):
+    """True if name is a single path component usable as an image directory"""
+    return (isinstance(name, str) and name not in ('', '.', '..', 'active-rootfs')
+            and '/' not in name and '\0' not in name)
+
+
+def get_version_name(filename):
+    """Generate version name from an uploaded image filename"""
+    for suffix in ('.img.gz', '.img', '.tar.gz'):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+class InvalidUploadName(ValueError):
+    """Upload filename can't be used as an image directory/file name"""
+
+
+class UploadWriter:
+    """Writable upload target that gunzips .gz files as they stream in"""
+    
+    def __init__(self, path, compressed):
+        self.path = path
+        self.file = open(path, 'wb', buffering=UPLOAD_CHUNK_SIZE)
+        self.decomp = zlib.decompressobj(31) if compressed else None
+    
+    def write(self, data):
+        if not self.decomp:
+            return self.file.write(data)
+        
+        size = len(data)
+        while data:
+            # Bound each block: zero-filled image regions compress ~1000:1
+            self.file.write(self.decomp.decompress(data, UPLOAD_CHUNK_SIZE))
+            if self.decomp.eof:
+                # Multi-member gzip: continue with the next member like gunzip does
+                data = self.decomp.unused_data
+                if data:
+                    self.decomp = zlib.decompressobj(31)
+            else:
+                data = self.decomp.unconsumed_tail
+        return size
+    
+    def seek(self, offset, whence=0):
+        # Werkzeug rewinds each file part once it's complete; nothing to do
+        return 0
+    
+    def close(self):
+        """Flush remaining data and check the gzip stream was complete"""
+        if self.file.closed:
+            return
+        try:
+            if self.decomp:
+                self.file.write(self.decomp.flush())
+                if not self.decomp.eof:
+                    raise ValueError('Upload ended before end of gzip stream')
+        finally:
+            self.file.close()
+    
+    def discard(self):
+        """Close and delete a partially written upload"""
+        self.file.close()
+        if self.path != os.devnull:
+            Path(self.path).unlink(missing_ok=True)
+            try:
+                # Only removes the version directory if this upload created it
+                Path(self.path).parent.rmdir()
+            except OSError:
+                pass
+
+
+def upload_stream_factory(total_content_length, content_type, filename, content_length=None):
+    """Werkzeug stream factory that writes uploads into their version directory"""
+    if not filename:
+        return UploadWriter(os.devnull, False)
+    
+    version_name = get_version_name(filename)
+    if not is_valid_version_name(filename) or not is_valid_version_name(version_name):
+        raise InvalidUploadName(f'Invalid upload filename: {filename}')
+    
+    version_dir = IMAGES_DIR / version_name
+    version_dir.mkdir(parents=True, exist_ok=True)
+    
+    if filename.endswith('.gz'):
+        return UploadWriter(version_dir / filename[:-len('.gz')], True)
+    return UploadWriter(version_dir / filename, False)
+
+
+def copy_tree(source, dest):
+    """Copy directory tree, sharing extents (reflink) where the filesystem supports it"""
+    result = subprocess.run(['cp', '-a', '--reflink=auto', str(source), str(dest)],
+                            capture_output=True, text=True)
+    if result.returncode == 0:
+        return
+    
+    # BusyBox cp (Alpine image) rejects --reflink before copying anything. Any
+    # other failure may have left a partial dest, where a retry would nest the
+    # copy inside it, so report it instead
+    if 'reflink' not in result.stderr:
+        raise subprocess.CalledProcessError(result.returncode, result.args,
+                                            result.stdout, result.stderr)
+    
+    print(f"cp --reflink not supported, using plain copy: {result.stderr.strip()}")
+    subprocess.run(['cp', '-a', str(source), str(dest)], check=True)
+
+
+def copy_file(source, dest):
+    """Copy file inside the kernel with copy_file_range, falling back to shutil"""
+    try:
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except OSError as e:
+        # Cross-filesystem copy or no kernel support
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        shutil.copyfile(source, dest)
+
+
+def send_image_file(path, mimetype):
+    """Stream a large file via the WSGI server's file_wrapper (sendfile under gunicorn)"""
+    stat = path.stat()
+    
+    if app.use_x_sendfile:
+        # Let the fronting server (Apache mod_xsendfile/lighttpd) serve the file itself
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = str(path.resolve())
+    else:
+        if request.range:
+            # Range responses seek to the start offset; the server's file_wrapper
+            # isn't seekable, so the range wrapper would read and drop the prefix
+            body = FileWrapper(open(path, 'rb'), buffer_size=SEND_CHUNK_SIZE)
+        else:
+            body = wrap_file(request.environ, open(path, 'rb'), buffer_size=SEND_CHUNK_SIZE)
+        response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    
+    response.content_length = stat.st_size
+    response.headers['Content-Disposition'] = f'attachment; filename="{path.name}"'
+    response.last_modified = stat.st_mtime
+    response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    
+    if app.use_x_sendfile:
+        # The fronting server sends the whole file (and handles Range itself),
+        # so only answer If-None-Match/If-Modified-Since here
+        return response.make_conditional(request)
+    
+    try:
+        # 304 for a matching If-None-Match, 206 for Range (resumed downloads)
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable as e:
+        response.close()
+        return e
+
+
+def get_rootfs_offset(img_path):
+    """Byte offset of the rootfs (second) partition in an .img file"""
+    result = subprocess.run(['sfdisk', '-J', str(img_path)],
+                            capture_output=True, text=True, check=True)
+    table = json.loads(result.stdout)['partitiontable']
+    sector_size = table.get('sectorsize', 512)
+    return table['partitions'][1]['start'] * sector_size
+
+
 def extract_rootfs(img_path, dest_dir):
-    """Extract rootfs from .img file using loop mount"""
-    # This is a placeholder - actual implementation needs privileged container
-    # For now, we'll assume user provides rootfs-raw directly
+    """Extract rootfs from .img file in a single pass"""
     dest_dir.mkdir(parents=True, exist_ok=True)
-    # TODO: Implement actual extraction logic
+    
+    try:
+        if shutil.which('guestfish'):
+            # Stream files straight out of the filesystem without mounting. Owner
+            # names in the archive come from the appliance's passwd, so keep the
+            # numeric uids/gids the NFS root needs
+            guestfish = subprocess.Popen(
+                ['guestfish', '--ro', '-a', str(img_path), '-m', '/dev/sda2', 'tar-out', '/', '-'],
+                stdout=subprocess.PIPE
+            )
+            try:
+                subprocess.run(['tar', '-x', '--numeric-owner', '-C', str(dest_dir)],
+                               stdin=guestfish.stdout, check=True)
+            finally:
+                guestfish.stdout.close()
+                guestfish.wait()
+            if guestfish.returncode != 0:
+                raise subprocess.CalledProcessError(guestfish.returncode, 'guestfish')
+            return
+        
+        # Loop-mount the rootfs partition read-only (needs privileged container)
+        offset = get_rootfs_offset(img_path)
+        mount_dir = tempfile.mkdtemp(prefix='netboot-rootfs-')
+        try:
+            subprocess.run(['mount', '-o', f'loop,ro,offset={offset}', str(img_path), mount_dir],
+                           capture_output=True, text=True, check=True)
+            try:
+                # Keep the image's numeric uids/gids rather than mapping names via our passwd
+                subprocess.run(['rsync', '-aHAX', '--numeric-ids', '--no-compress',
+                                f'{mount_dir}/', f'{dest_dir}/'],
+                               check=True)
+            finally:
+                subprocess.run(['umount', mount_dir], capture_output=True)
+        finally:
+            os.rmdir(mount_dir)
+    except (OSError, ValueError, KeyError, IndexError, subprocess.CalledProcessError) as e:
+        # Image can still be written to disk; rootfs-raw must then be provided directly.
+        # Don't leave a half-copied tree that could be activated and netbooted
+        print(f"Could not extract rootfs from {img_path}: {e}")
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+
+
+def write_size_marker(version_dir):
+    """Record image size at import time so listing doesn't walk the tree"""
+    (version_dir / SIZE_MARKER).write_text(str(get_dir_size(version_dir)))
+
+
+def read_size_marker(path):
+    """Get image size in MB from its size marker, or None if it has none"""
+    try:
+        return float((path / SIZE_MARKER).read_text())
+    except (OSError, ValueError):
+        return None
 
 
 def get_dir_size(path):
-    """Get directory size in MB"""
+    """Get directory size in MB, walking the tree with os.scandir"""
+    # Not cached: a directory's mtime doesn't change when files below it grow
     total = 0
-    for entry in path.rglob('*'):
-        if entry.is_file():
-            total += entry.stat().st_size
+    stack = [str(path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            # Entries can vanish or be unreadable while an image is being extracted
+            continue
     return round(total / 1024 / 1024, 1)
 
 
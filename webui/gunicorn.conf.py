@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for the pi-netboot-server Web UI
+The API is I/O bound (subprocesses, GitHub/Pi HTTP calls, file copies), so a
+single worker with a thread pool keeps UI polls responsive during long
+requests and shares in-process caches between threads
+"""
+
+import os
+
+bind = '0.0.0.0:38434'
+worker_class = 'gthread'
+workers = 1
+# Not tied to CPU count: threads mostly wait on I/O, and release downloads,
+# uploads and imports each hold one for minutes, so leave plenty for UI polls
+threads = int(os.environ.get('WEBUI_THREADS', 32))
+timeout = 120
+graceful_timeout = 30
+keepalive = 5